@@ -1,21 +1,38 @@
+import os
+import re
 import streamlit as st
 import pdfplumber
+try:
+    import fitz  # PyMuPDF; optional — AGPL, so some deploys stay on pdfplumber
+except ImportError:
+    fitz = None
+import numpy as np
 import pandas as pd
+try:
+    import python_calamine  # noqa: F401  (Rust Excel reader; optional)
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
 from datetime import datetime, timedelta
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from openpyxl.styles import PatternFill, Alignment
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
 # Constants
 days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri']
+DAY_SET = frozenset(days)
+
+# Arrivals strictly before 06:01:00 count as on time
+CUTOFF_SECONDS = 6 * 3600 + 1 * 60
 
 # Actual Google Sheet URL
 SHEET_URL = "https://docs.google.com/spreadsheets/d/1Y8nSTQUZ5qWborDOlPxzh9K48Ls2Hpky4vf36Pej7d8/edit?usp=sharing"
 
 # --- Google Sheets functions ---
 
+@st.cache_resource
 def get_gsheet_client():
     scope = [
         "https://spreadsheets.google.com/feeds",
@@ -28,93 +45,140 @@ def get_gsheet_client():
     client = gspread.authorize(creds)
     return client
 
-def load_saved_names_from_gs(sheet_url):
+@st.cache_resource
+def get_names_worksheet(sheet_url):
     client = get_gsheet_client()
     sheet = client.open_by_url(sheet_url)
-    worksheet = sheet.worksheet("names")
+    return sheet.worksheet("names")
+
+@st.cache_data(ttl=60)
+def load_saved_names_from_gs(sheet_url):
+    worksheet = get_names_worksheet(sheet_url)
     records = worksheet.get_all_records()
     return [(row['Surname'], row['FirstName']) for row in records]
 
+def parse_names(text):
+    names = []
+    for line in text.splitlines():
+        surname, sep, first_name = line.partition(',')
+        if sep:
+            surname, first_name = surname.strip(), first_name.strip()
+            if surname and first_name:
+                names.append((surname, first_name))
+    return names
+
 def save_names_to_gs(sheet_url, names_list):
-    client = get_gsheet_client()
-    sheet = client.open_by_url(sheet_url)
-    worksheet = sheet.worksheet("names")
-    worksheet.clear()
-    worksheet.append_row(["Surname", "FirstName"])
-    for surname, first_name in names_list:
-        worksheet.append_row([surname, first_name])
+    worksheet = get_names_worksheet(sheet_url)
+    rows = [["Surname", "FirstName"]] + [[surname, first_name] for surname, first_name in names_list]
+    # Pad with blanks up to the sheet's current height so one update call
+    # both writes the new list and wipes any leftover rows — no separate
+    # clear() round-trip.
+    rows += [["", ""]] * max(0, worksheet.row_count - len(rows))
+    worksheet.update(range_name="A1", values=rows, value_input_option="RAW")
 
 # --- PDF + Attendance functions ---
 
 def group_words_to_rows(words, tolerance=3):
-    rows, current_row, last_top = [], [], None
-    for w in words:
-        top = w['top']
-        if last_top is None or abs(top - last_top) <= tolerance:
-            current_row.append(w)
-            last_top = top if last_top is None else (last_top + top) / 2
-        else:
-            rows.append(current_row)
-            current_row, last_top = [w], top
-    if current_row:
-        rows.append(current_row)
-    return rows
+    if not words:
+        return []
+    tops = np.fromiter((w['top'] for w in words), dtype=np.float32, count=len(words))
+    order = np.argsort(tops, kind='stable')
+    # A gap in top coordinate larger than the tolerance starts a new row.
+    breaks = np.flatnonzero(np.diff(tops[order]) > tolerance) + 1
+    return [[words[i] for i in chunk] for chunk in np.split(order, breaks)]
+
+def extract_words_from_pdf(pdf_file):
+    if fitz is not None:
+        with fitz.open(stream=pdf_file.read(), filetype="pdf") as doc:
+            words = [{'x0': w[0], 'top': w[1], 'text': w[4]}
+                     for w in doc.load_page(0).get_text("words")]
+    else:
+        with pdfplumber.open(pdf_file, pages=[1]) as pdf:
+            words = pdf.pages[0].extract_words()
+    # No pre-sort needed: group_words_to_rows argsorts the top coordinates
+    # itself and each row is re-sorted by x0 when the table is built.
+    return words
 
 def extract_table_from_pdf(pdf_file):
-    with pdfplumber.open(pdf_file) as pdf:
-        page = pdf.pages[0]
-        words = sorted(page.extract_words(), key=lambda w: (w['top'], w['x0']))
-        rows = group_words_to_rows(words)
-        return [[w['text'] for w in sorted(row, key=lambda w: w['x0'])] for row in rows]
+    words = extract_words_from_pdf(pdf_file)
+    for row in group_words_to_rows(words):
+        yield [w['text'] for w in sorted(row, key=lambda w: w['x0'])]
 
 def process_pdf(pdf_file):
     table = extract_table_from_pdf(pdf_file)
     filtered = [row for row in table if len(row) == 12 and row[0] == 'IMSL']
-    attendance = {}
-    cutoff_time = datetime.strptime("06:01:00", "%H:%M:%S").time()
-    for row in filtered:
-        surname, first_name, time_str, day_str = row[3].rstrip(','), row[4], row[8], row[6]
-        time_obj = datetime.strptime(time_str, "%H:%M:%S").time()
-        flag = 'Y' if time_obj < cutoff_time else 'L'
-        attendance[(surname, first_name)] = (day_str, flag)
-    return attendance
+    if not filtered:
+        return []
+    df = pd.DataFrame(filtered)
+    # Times are fixed-format HH:MM:SS, so slice to integer seconds rather
+    # than paying for a strptime per row.
+    t = df[8].str
+    seconds = t[0:2].astype(int) * 3600 + t[3:5].astype(int) * 60 + t[6:8].astype(int)
+    flags = np.where(seconds < CUTOFF_SECONDS, 'Y', 'L')
+    surnames = df[3].str.rstrip(',')
+    return list(zip(surnames, df[4], df[6], flags))
+
+@st.cache_data(show_spinner=False, persist="disk")
+def process_pdf_bytes(pdf_bytes):
+    # Keyed on the file's bytes, so a rerun with the same uploads skips
+    # the parse entirely; persisted so the cache survives app restarts.
+    return process_pdf(BytesIO(pdf_bytes))
+
+def collect_pdf_records(files):
+    # Parse the week's PDFs in parallel (each file is independent) and
+    # return one long list of (Surname, FirstName, Day, Flag) records,
+    # in file order so later files win on conflicts.
+    with ThreadPoolExecutor(max_workers=min(8, len(files))) as executor:
+        results = executor.map(process_pdf_bytes, [file.getvalue() for file, _ in files])
+    return [record for records in results for record in records]
+
+@st.cache_data(show_spinner=False)
+def read_excel_bytes(excel_bytes):
+    return pd.read_excel(BytesIO(excel_bytes), engine=EXCEL_ENGINE)
+
+# Filenames start with the date as DD_MM_YYYY or DD.MM.YYYY
+DATE_RE = re.compile(r'^(\d{1,2})[._](\d{1,2})[._](\d{2,4})')
 
 def extract_date_from_filename(filename):
-    name, _ = filename.rsplit('.', 1)
-    for sep in ['_', '.']:
-        parts = name.split(sep)
-        if len(parts) >= 3:
-            try:
-                return datetime(int(parts[2]), int(parts[1]), int(parts[0]))
-            except:
-                continue
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    match = DATE_RE.match(stem)
+    if match:
+        day, month, year = map(int, match.groups())
+        try:
+            return datetime(year, month, day)
+        except ValueError:
+            return None
     return None
 
+@st.cache_data(show_spinner=False)
 def style_excel(df):
     with BytesIO() as output:
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
             df.to_excel(writer, index=False)
             wb = writer.book
-            ws = wb.active
-
-            fill_map = {
-                'Y': PatternFill(start_color='FF00FF00', end_color='FF00FF00', fill_type='solid'),  # Green
-                'L': PatternFill(start_color='FFFFFF00', end_color='FFFFFF00', fill_type='solid'),  # Yellow
-                'A': PatternFill(start_color='FFFF0000', end_color='FFFF0000', fill_type='solid'),  # Red
-                'H': PatternFill(start_color='FFFFC0CB', end_color='FFFFC0CB', fill_type='solid'),  # Pink (LightPink)
+            ws = writer.sheets['Sheet1']
+
+            center = {'align': 'center', 'valign': 'vcenter'}
+            color_map = {
+                'Y': '#00FF00',  # Green
+                'L': '#FFFF00',  # Yellow
+                'A': '#FF0000',  # Red
+                'H': '#FFC0CB',  # Pink (LightPink)
             }
-            center_align = Alignment(horizontal='center', vertical='center')
 
-            # Adjust width for day columns (from column 3 to last column)
-            for col_idx in range(3, ws.max_column + 1):
-                ws.column_dimensions[chr(64 + col_idx)].width = 20
+            # Adjust width (and centre) the day columns (from column 3 to last column)
+            ws.set_column(2, len(df.columns) - 1, 20, wb.add_format(center))
 
-            for row in range(2, ws.max_row + 1):
-                for col_idx in range(3, ws.max_column + 1):
-                    cell = ws.cell(row=row, column=col_idx)
-                    if cell.value in fill_map:
-                        cell.fill = fill_map[cell.value]
-                    cell.alignment = center_align
+            # Let Excel colour the flags itself: one conditional rule per
+            # flag instead of touching every cell from Python.
+            for flag, color in color_map.items():
+                fmt = wb.add_format({'bg_color': color, **center})
+                ws.conditional_format(1, 2, len(df), len(df.columns) - 1, {
+                    'type': 'cell',
+                    'criteria': '==',
+                    'value': f'"{flag}"',
+                    'format': fmt,
+                })
 
         return output.getvalue()
 
@@ -122,8 +186,10 @@ def style_excel(df):
 
 st.title("📋 Attendance Tracker")
 
-# Load saved always-included names from Google Sheets
-always_include = load_saved_names_from_gs(SHEET_URL)
+# Load saved always-included names from Google Sheets once per session
+if 'always_include' not in st.session_state:
+    st.session_state.always_include = load_saved_names_from_gs(SHEET_URL)
+always_include = st.session_state.always_include
 
 # --- Labour List input and save ---
 st.subheader("👥 Labour List")
@@ -137,14 +203,11 @@ names_input = st.text_area(
 )
 
 if st.button("💾 Save names"):
-    new_names = []
-    for line in names_input.splitlines():
-        if ',' in line:
-            surname, first_name = map(str.strip, line.split(',', 1))
-            if surname and first_name:
-                new_names.append((surname, first_name))
+    new_names = parse_names(names_input)
     save_names_to_gs(SHEET_URL, new_names)
+    load_saved_names_from_gs.clear()
     st.success("Names saved successfully!")
+    st.session_state.always_include = new_names
     always_include = new_names
 
 # --- Weekly attendance uploads ---
@@ -170,74 +233,50 @@ if uploaded_pdfs:
     for week_key, files in weeks.items():
         st.subheader(f"📅 Week {week_key}")
 
-        # Load existing Excel data if provided
+        # Seed the week grid from the existing Excel if one was provided
         if uploaded_excel:
-            df_existing = pd.read_excel(uploaded_excel)
+            df_uploaded = read_excel_bytes(uploaded_excel.getvalue())
             st.write("Loaded existing attendance data:")
-            st.dataframe(df_existing)
-            # Prepare existing attendance data dict for updating
-            all_attendance = defaultdict(lambda: {day: 'A' for day in days})
-
-            # Map current dataframe into all_attendance dictionary
-            # Extract base day names (without dates)
-            base_days = days
-            # Columns from 3rd onwards have date suffixes, map them back to base days:
-            col_day_map = {}
-            for col in df_existing.columns[2:]:
-                # extract the day part from header like 'Mon 01/06/2025'
-                base_day = col.split(' ')[0]
-                col_day_map[col] = base_day
-
-            for _, row in df_existing.iterrows():
-                surname = row['Surname']
-                first_name = row['FirstName']
-                # Initialize if missing
-                if (surname, first_name) not in all_attendance:
-                    all_attendance[(surname, first_name)] = {day: 'A' for day in days}
-                for col in df_existing.columns[2:]:
-                    day = col_day_map[col]
-                    all_attendance[(surname, first_name)][day] = row[col]
-
-            # Update attendance from PDFs
-            for file, _ in files:
-                attendance_for_day = process_pdf(file)
-                for (surname, first_name), (day_str, flag) in attendance_for_day.items():
-                    if day_str in days:
-                        all_attendance[(surname, first_name)][day_str] = flag
-
-            # Ensure always_include names are present
-            for name_tuple in always_include:
-                if name_tuple not in all_attendance:
-                    all_attendance[name_tuple] = {day: 'A' for day in days}
-
-            # Build rows list
-            rows = []
-            for (surname, first_name), day_flags in all_attendance.items():
-                row = [surname, first_name] + [day_flags[day] for day in days]
-                rows.append(row)
-
-            df_existing = pd.DataFrame(rows, columns=['Surname', 'FirstName'] + days)
-        else:
-            # If no existing Excel, build from PDFs only
-            all_attendance = defaultdict(lambda: {day: 'A' for day in days})
+            st.dataframe(df_uploaded)
 
-            for file, _ in files:
-                attendance_for_day = process_pdf(file)
-                for (surname, first_name), (day_str, flag) in attendance_for_day.items():
-                    if day_str in days:
-                        all_attendance[(surname, first_name)][day_str] = flag
-
-            for name_tuple in always_include:
-                if name_tuple not in all_attendance:
-                    all_attendance[name_tuple] = {day: 'A' for day in days}
-
-            rows = []
-            for (surname, first_name), day_flags in all_attendance.items():
-                row = [surname, first_name] + [day_flags[day] for day in days]
-                rows.append(row)
+            # Strip the date suffixes from headers like 'Mon 01/06/2025'
+            week = df_uploaded.set_index(['Surname', 'FirstName'])
+            week.columns = [col.split(' ')[0] for col in week.columns]
+            week = week.reindex(columns=days, fill_value='A')
+        else:
+            week = pd.DataFrame(
+                columns=days,
+                index=pd.MultiIndex.from_arrays([[], []], names=['Surname', 'FirstName'])
+            )
+
+        # Pivot the week's PDF records and lay them over the existing grid
+        records = pd.DataFrame(collect_pdf_records(files),
+                               columns=['Surname', 'FirstName', 'Day', 'Flag'])
+        records = records[records['Day'].isin(DAY_SET)]
+        update = None
+        if len(records):
+            update = records.pivot_table(index=['Surname', 'FirstName'], columns='Day',
+                                         values='Flag', aggfunc='last')
+
+        # Everyone seen anywhere (Excel, PDFs, always-include list) gets a row
+        names = week.index if update is None else week.index.union(update.index)
+        if always_include:
+            names = names.union(pd.MultiIndex.from_tuples(always_include, names=['Surname', 'FirstName']))
+        week = week.reindex(names)
+        if update is not None:
+            week.update(update)
+
+        df_existing = week.reindex(columns=days).fillna('A').reset_index()
+
+        # Flags only take a handful of values; hold them as categorical
+        # codes rather than one string object per cell. Hand-edited sheets
+        # can carry custom markers, so keep any observed value as a category
+        # instead of nulling it.
+        base_flags = ['Y', 'L', 'A', 'H']
+        for day in days:
+            extras = [v for v in pd.unique(df_existing[day]) if v not in base_flags]
+            df_existing[day] = pd.Categorical(df_existing[day], categories=base_flags + extras)
 
-            df_existing = pd.DataFrame(rows, columns=['Surname', 'FirstName'] + days)
-        
         # Add date suffixes to days in columns
         year, week_num = map(int, week_key.split('-W'))
         monday_date = datetime.strptime(f"{year} {week_num} 1", "%G %V %u")